@@ -10,6 +10,7 @@ sys.path.insert(0, parent_dir)
 
 from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
 import getpass
+import logging
 import numpy as np
 import xarray as xr
 import rasterio as rio
@@ -25,6 +26,9 @@ from ftplib import FTP
 from Sentinel2_Data import *
 from datacube_sst import *
 
+'''Logging config for the whole dataprocess, the modules only log through their own loggers'''
+logging.basicConfig(level = logging.INFO)
+
 
 '''Dask Cluster'''
 from dask.distributed import Client, LocalCluster
@@ -94,8 +98,8 @@ def load_collection(collection, start, end):
         else:
             raise FileNotFoundError("Directory empty")
     elif collection == "Sentinel2":
-        if os.path.exists(directorySentinel + nameSentinel + ".nc"):
-            Sentinel = xr.open_dataset(directorySentinel + nameSentinel + ".nc")
+        if os.path.exists(directorySentinel + nameSentinel + ".zarr"):
+            Sentinel = xr.open_zarr(directorySentinel + nameSentinel + ".zarr")
             timeframe = [start,end]
             Sentinel_sel = get_time_sub_datacube(Sentinel, timeframe)
             Sentinel.close()
@@ -4,18 +4,25 @@
 
 from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
 import getpass
+import dask
+import logging
+import glob
+import hashlib
+import numcodecs
 import numpy as np
 import xarray as xr
-import rasterio as rio
+import rioxarray
 import os
+from numba import njit, prange
 import pandas as pd
 import shutil
 import stat
-from rasterio.enums import Resampling
 from datetime import datetime
 from zipfile import ZipFile
-from ftplib import FTP 
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP
 
+log = logging.getLogger(__name__)
 
 
 class NoPath(Exception):
@@ -70,9 +77,38 @@ def downloadingData(aoi, collectionDate, plName, prLevel, clouds, username, pass
     '''Downloads the choosen files from Scihub'''
     if len(products)==0:
         raise Exception("No data for this params")
-    print("Start downloading " + str(len(products)) + " product(s)")
-    api.download_all(products, directory, max_attempts = 10, checksum = True)
-    print("All necassary downloads done")
+    log.info("Start downloading " + str(len(products)) + " product(s)")
+    '''Downloads are network-bound, so several products stream concurrently instead of the sentinelsat default of 2.
+    checksum=False keeps the MD5 re-read out of the download loop, the batch verification below hashes all archives in parallel afterwards'''
+    downloaded, triggered, failed = api.download_all(products, directory, max_attempts = 10, checksum = False, n_concurrent_dl = 8)
+    verifyChecksums(downloaded, directory)
+    log.info("All necassary downloads done")
+
+
+
+
+
+def verifyChecksums(downloaded, directory):
+    '''
+    Verifies the MD5 checksums of the downloaded products against the server values
+
+    Parameters:
+        downloaded (dict): The product infos returned by api.download_all
+        directory (str): Pathlike string to the download directory
+    '''
+
+    def verifyMD5(productInfo):
+        '''Products whose zip already existed on disk carry no path in their info, only title and md5'''
+        path = productInfo.get('path', os.path.join(directory, productInfo['title'] + '.zip'))
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+        if md5.hexdigest().lower() != productInfo['md5'].lower():
+            raise Exception("Checksum mismatch for " + path)
+
+    with ThreadPoolExecutor(max_workers = os.cpu_count()) as executor:
+        list(executor.map(verifyMD5, downloaded.values()))
 
 
 
@@ -94,23 +130,28 @@ def unzipping(filename, directory):
 
 def unzip(directory):
     '''
-    Unzips and deletes the .zip in the given directory
+    Unzips and deletes the .zip in the given directory, one thread per archive
 
     Parameters:
         directory (str): Pathlike string to the directory
     '''
 
+    zips = []
     for filename in os.listdir(directory):
         if filename.endswith(".zip"):
             if(filename[39:41]!="32"):
-                print("CRS not supported! Only EPSG:32632 supported")
+                log.warning("CRS not supported! Only EPSG:32632 supported")
                 delete(os.path.join(directory,filename))
             else:
-                unzipping(filename, directory)
-                delete(os.path.join(directory, filename))
-                continue
-        else:
-            continue
+                zips.append(filename)
+
+    def unzipAndDelete(filename):
+        unzipping(filename, directory)
+        delete(os.path.join(directory, filename))
+
+    '''ZipFile inflates in zlib C code which releases the GIL, so the archives decompress in parallel'''
+    with ThreadPoolExecutor(max_workers = os.cpu_count()) as executor:
+        list(executor.map(unzipAndDelete, zips))
 
 
 
@@ -128,34 +169,22 @@ def extractBands(filename, resolution, directory):
     '''
 
     try:
-        lTwoA = os.listdir(os.path.join(directory, filename, "GRANULE"))
+        '''One granule walk and one glob per band instead of a fresh listing per resolution branch'''
+        granuleParent = os.path.join(directory, filename, "GRANULE")
+        granule = sorted(os.listdir(granuleParent))[0]
+        resFolder = {10: "R10m", 20: "R20m", 60: "R60m", 100: "R20m"}
+        if resolution not in resFolder:
+            raise NoResolution("Invalid Resolution, try 10, 20, 60 or 100")
+        imgData = os.path.join(granuleParent, str(granule), "IMG_DATA", resFolder[resolution])
+        '''Globs the bands by name, positional indexing into the listing breaks as soon as the folder layout changes'''
         if resolution == 10:
-            bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m"))
-            pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m", str(bandName[3]))
-            pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m", str(bandName[4]))
-            bandPaths = [pathRed, pathNIR]
-
-        elif resolution == 20:
-            bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m"))
-            pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[3]))
-            pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[9]))
-            bandPaths = [pathRed, pathNIR]
-
-        elif resolution == 60:
-            bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m"))
-            pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m", str(bandName[4]))
-            pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m", str(bandName[11]))
-            bandPaths = [pathRed, pathNIR]
-
-        elif resolution == 100:
-            bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m"))
-            pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[3]))
-            pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[9]))
-            bandPaths = [pathRed, pathNIR]
-
+            nirPattern = "*_B08_*.jp2"
         else:
-               raise NoResolution("Invalid Resolution, try 10, 20, 60 or 100")
-    except FileNotFoundError:
+            nirPattern = "*_B8A_*.jp2"
+        pathRed = glob.glob(os.path.join(imgData, "*_B04_*.jp2"))[0]
+        pathNIR = glob.glob(os.path.join(imgData, nirPattern))[0]
+        bandPaths = [pathRed, pathNIR]
+    except (FileNotFoundError, IndexError):
         raise NoPath("No file in this path")
     return bandPaths
 
@@ -178,74 +207,40 @@ def loadBand (bandpath, date, tile, resolution, clouds, plName, prLevel, directo
     Returns:
         dataset (xArray dataset): The result dataset as xArray dataset
     '''
-    
-    
-    b4 = rio.open(bandpath[0])
-    b8 = rio.open(bandpath[1])
-    red = b4.read()
-    nir = b8.read()
-
-    if resolution == 10:
-        res = 1830 * 3 * 2
-    elif resolution == 20:
-        res = 1830 * 3
-    elif resolution == 60:
-        res = 1830
-    elif resolution == 100:
-        res = 1098
-    else:
+
+
+    if resolution not in (10, 20, 60, 100):
         raise NoResolution("Invalid Resolution, try 10, 20, 60 or 100")
 
-    j = res - 1
-    i = 0
-    lat = [0] * res
-    lon = [0] * res
-    while j >= 0:
-        lon[i] = b4.bounds.left + i * resolution
-        lat[i] = b4.bounds.bottom + j * resolution
-        i = i + 1
-        j = j - 1
+    '''GDAL picks this up in the dask worker threads for parallel JP2 decoding'''
+    os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+    '''Also avoids per-open directory scans and enables multiplexed range requests, so bandpath may point at COG mirrors (e.g. sentinel-s2-l2a-cogs) as well as local JP2s'''
+    os.environ.setdefault("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    os.environ.setdefault("GDAL_HTTP_MULTIPLEX", "YES")
+    os.environ.setdefault("GDAL_HTTP_MERGE_CONSECUTIVE_RANGES", "YES")
 
-    time = pd.date_range(date, periods = 1)
+    '''Dask-backed lazy reads, only chunk-sized pieces are materialized while to_netcdf computes'''
+    red = rioxarray.open_rasterio(bandpath[0], chunks = {'x': 2048, 'y': 2048}, lock = False).squeeze('band', drop = True)
+    nir = rioxarray.open_rasterio(bandpath[1], chunks = {'x': 2048, 'y': 2048}, lock = False).squeeze('band', drop = True)
 
     if resolution == 100:
-        upscale_factor = (1/5)
-        nir = b8.read(
-                out_shape = (
-                    b8.count,
-                    int(b8.height * upscale_factor),
-                    int(b8.width * upscale_factor)
-                ),
-                resampling = Resampling.bilinear
-        )
-        transform = b8.transform * b8.transform.scale(
-            (b8.width / nir.shape[-1]),
-            (b8.height / nir.shape[-2])
-        )
-        red = b4.read(
-            out_shape = (
-                b4.count,
-                int(b4.height * upscale_factor),
-                int(b4.width * upscale_factor)
-            ),
-            resampling = Resampling.bilinear
-        )
-
-        transform = b4.transform * b4.transform.scale(
-            (b4.width / red.shape[-1]),
-            (b4.height / red.shape[-2])
-        )
+        '''Downsamples the 20m bands to 100m by lazy block mean'''
+        red = red.coarsen(x = 5, y = 5, boundary = 'trim').mean()
+        nir = nir.coarsen(x = 5, y = 5, boundary = 'trim').mean()
+
+    '''Sentinel L2A reflectance is bounded 0-10000, so uint16 suffices and halves the bytes of any float upcast from resampling'''
+    red = red.astype(np.uint16)
+    nir = nir.astype(np.uint16)
+
+    time = pd.date_range(date, periods = 1)
+    red = red.rename({'x': 'lon', 'y': 'lat'}).expand_dims(time = time)
+    nir = nir.rename({'x': 'lon', 'y': 'lat'}).expand_dims(time = time)
 
     dataset = xr.Dataset(
         {
-            "red": (["time","lat", "lon"], red),
-            "nir": (["time","lat", "lon"], nir)
+            "red": red,
+            "nir": nir
         },
-        coords = dict(
-            time = time,
-            lat = (["lat"], lat),
-            lon = (["lon"], lon),
-        ),
         attrs = dict(
             platform = plName,
             processingLevel = prLevel,
@@ -254,15 +249,49 @@ def loadBand (bandpath, date, tile, resolution, clouds, plName, prLevel, directo
         ),
     )
 
-    dataset.to_netcdf(directory + "datacube_" + str(date) + "_" + str(tile) + "_R" + str(resolution) + ".nc", 'w', format = 'NETCDF4')
-    b4.close()
-    b8.close()
+    '''Chunked deflate-compressed blocks instead of one monolithic uncompressed write'''
+    encoding = {
+        "red": {"zlib": True, "complevel": 4, "dtype": "uint16", "chunksizes": (1, min(1024, dataset.dims["lat"]), min(1024, dataset.dims["lon"]))},
+        "nir": {"zlib": True, "complevel": 4, "dtype": "uint16", "chunksizes": (1, min(1024, dataset.dims["lat"]), min(1024, dataset.dims["lon"]))}
+    }
+    dataset.to_netcdf(directory + "datacube_" + str(date) + "_" + str(tile) + "_R" + str(resolution) + ".nc", 'w', format = 'NETCDF4', encoding = encoding, compute = True)
     return dataset
 
 
 
 
 
+@njit(parallel = True, fastmath = True, cache = True)
+def ndvi(red, nir):
+    '''
+    Computes the NDVI (nir - red) / (nir + red) for two bands
+
+    Compiled with numba so the per-pixel loop runs vectorized and multithreaded,
+    a Python loop over a full 10m band would take minutes
+    Parameters:
+        red (ndarray): The red band as uint16 array
+        nir (ndarray): The nir band as uint16 array
+    Returns:
+        out (ndarray): The NDVI as float32 array, 0 where both bands are 0
+    '''
+
+    out = np.empty(red.shape, dtype = np.float32)
+    redFlat = red.ravel()
+    nirFlat = nir.ravel()
+    outFlat = out.ravel()
+    for k in prange(redFlat.size):
+        redVal = np.float32(redFlat[k])
+        nirVal = np.float32(nirFlat[k])
+        if nirVal + redVal == 0:
+            outFlat[k] = 0
+        else:
+            outFlat[k] = (nirVal - redVal) / (nirVal + redVal)
+    return out
+
+
+
+
+
 def getDate(filename):
     '''
     Extracts the Date out of the Sentinelfilename
@@ -304,6 +333,25 @@ def on_rm_error(func, path, exc_info):
 
 
 
+def processScene(filename, directory, resolution, clouds, plName, prLevel):
+    '''
+    Extracts, loads and saves the bands of a single .SAFE scene
+    Parameters:
+        filename (str): Sentinel .SAFE file
+        directory (str): Pathlike string to the directory
+        resolution (int): The resolution of the dataset
+        clouds (tuple of ints): Min and max of cloudcoverpercentage
+        plName (str): The name of the platform
+        prLevel (str): The level of the process
+    '''
+
+    bandPath = extractBands(os.path.join(directory, filename), resolution, directory)
+    loadBand(bandPath, getDate(filename), getTile(filename), resolution, clouds, plName, prLevel, directory)
+
+
+
+
+
 def buildCube(directory, resolution, clouds, plName, prLevel):
     '''
     Builds a datacube in the given directory with coords, time as dimensions and the bands as datavariables
@@ -314,21 +362,19 @@ def buildCube(directory, resolution, clouds, plName, prLevel):
         plName (str): The name of the platform
         prLevel (str): The level of the process
     '''
-    
-    i = 0
-    for filename in os.listdir(directory):
-        if filename.endswith(".SAFE"):
-            i = i + 1
-    if i == 0:
+
+    '''One cached directory walk instead of one listdir to count and one to process'''
+    safeFiles = [entry.name for entry in os.scandir(directory) if entry.name.endswith(".SAFE")]
+    if len(safeFiles) == 0:
         raise NoSafeFileError ("In this directory is no SAFE file to build a cube")
-    for filename in os.listdir(directory):
-        if filename.endswith(".SAFE"):
-            bandPath = extractBands(os.path.join(directory, filename), resolution, directory)
-            band = loadBand(bandPath, getDate(filename), getTile(filename), resolution, clouds, plName, prLevel, directory)
-            shutil.rmtree(os.path.join(directory, filename), onerror = on_rm_error)
-            continue
-        else:
-            continue
+
+    '''The scenes share no state, so each one becomes a delayed task and dask processes them in parallel'''
+    tasks = [dask.delayed(processScene)(filename, directory, resolution, clouds, plName, prLevel) for filename in safeFiles]
+    dask.compute(*tasks, scheduler = 'processes')
+
+    '''An L2A scene holds hundreds of small files, so the extracted trees are removed by parallel threads once all scenes are processed'''
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        list(executor.map(lambda f: shutil.rmtree(os.path.join(directory, f), onerror = on_rm_error), safeFiles))
 
 
 
@@ -351,56 +397,66 @@ def merge_Sentinel(directory, nameSentinel):
     if len(files) == 0:
         raise FileNotFoundError("Directory empty")
     elif len(files) == 1:
-        print("Only one file in directory")
+        log.info("Only one file in directory")
         os.rename(directory + (os.listdir(directory)[0]), directory + "merged_cube.nc")
         return
     else:
-        print('Start merging')
-        for file1 in files:
-            for file2 in files:
-                file1Date = file1[9:19]
-                file1Tile = file1[20:26]
-                file1Res = file1[27:31]
-                file2Date = file2[9:19]
-                file2Tile = file2[20:26]
-                file2Res = file2[27:31]
-                if file1[21:23] == "31":
-                    delete(os.path.join(directory,file1))
-                elif file2[21:23] == "31":
-                    delete(os.path.join(directory,file2))
-                elif file1Date == file2Date and file1Tile == file2Tile and file1Res == file2Res:
-                    continue
-                elif file1Date == file2Date and file1Tile == "T32ULC" and file2Tile == "T32UMC" and file1Res == file2Res:
-                    fileLeft = xr.open_dataset(os.path.join(directory, file1))
-                    fileRight = xr.open_dataset(os.path.join(directory, file2))
-                    merge_coords(fileLeft, fileRight, file1[0:20] + "Merged" + file1[26:31], directory)
-                    fileLeft.close()
-                    fileRight.close()
-                    delete(os.path.join(directory, file1))
-                    delete(os.path.join(directory, file2))                   
-
-    ds_merge = []
-    files = []
-    for f in os.listdir(directory):
-        x = xr.open_dataset(os.path.join(directory, f))
-        ds_merge.append(x)
-        files.append(os.path.join(directory, f))
-#   datacube = xr.open_mfdataset(files)#none dask
-    datacube = xr.open_mfdataset(files, parallel=True, chunks={"time": "auto"})#with dask
+        log.info('Start merging')
+        '''Parses every filename once and groups by date and resolution, so each tile pair is merged exactly once'''
+        groups = {}
+        for filename in files:
+            fileDate = filename[9:19]
+            fileTile = filename[20:26]
+            fileRes = filename[27:31]
+            if filename[21:23] == "31":
+                delete(os.path.join(directory, filename))
+            else:
+                groups.setdefault((fileDate, fileRes), {})[fileTile] = filename
+
+    '''The merged tile pairs stay lazy in memory instead of taking a round-trip through an intermediate NetCDF'''
+    cubes = []
+    opened = []
+    keptFiles = []
+    for (fileDate, fileRes), tiles in sorted(groups.items()):
+        remaining = dict(tiles)
+        if "T32ULC" in tiles and "T32UMC" in tiles:
+            fileLeft = xr.open_dataset(os.path.join(directory, tiles["T32ULC"]), chunks = {"lat": 1024, "lon": 1024})
+            fileRight = xr.open_dataset(os.path.join(directory, tiles["T32UMC"]), chunks = {"lat": 1024, "lon": 1024})
+            cubes.append(merge_coords(fileLeft, fileRight))
+            opened.extend([fileLeft, fileRight])
+            keptFiles.extend([tiles["T32ULC"], tiles["T32UMC"]])
+            del remaining["T32ULC"]
+            del remaining["T32UMC"]
+        '''Every tile without a merge partner still belongs into the cube, also next to a merged pair'''
+        for fileTile in remaining:
+            single = xr.open_dataset(os.path.join(directory, remaining[fileTile]), chunks = {"lat": 1024, "lon": 1024})
+            cubes.append(single)
+            opened.append(single)
+            keptFiles.append(remaining[fileTile])
+    datacube = xr.concat(cubes, dim = "time")
     '''save datacube'''
-    print("Start saving")
-    datacube.to_netcdf(directory + nameSentinel + ".nc", compute = True)
-    print("Done saving")
+    log.info("Start saving")
+    '''The lon concat in merge_coords leaves uneven dask chunks (e.g. 1000 at the tile seam), which to_zarr refuses to map onto the 1024 zarr chunks, so the cube is rechunked to the write layout first'''
+    datacube = datacube.chunk({"time": 1, "lat": min(1024, datacube.dims["lat"]), "lon": min(1024, datacube.dims["lon"])})
+    '''Zarr lets every dask worker write its own compressed chunks in parallel instead of funnelling the whole graph through one NetCDF writer'''
+    compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.BITSHUFFLE)
+    encoding = {
+        "red": {"compressor": compressor, "chunks": (1, min(1024, datacube.dims["lat"]), min(1024, datacube.dims["lon"]))},
+        "nir": {"compressor": compressor, "chunks": (1, min(1024, datacube.dims["lat"]), min(1024, datacube.dims["lon"]))}
+    }
+    delayed = datacube.to_zarr(directory + nameSentinel + ".zarr", mode = "w", compute = False, encoding = encoding)
+    delayed.compute()
+    log.info("Done saving")
     datacube.close()
 
-    for f in ds_merge:
-        f.close()
-    for f in files:
-        delete(f)
-        
+    for ds in opened:
+        ds.close()
+    for f in keptFiles:
+        delete(os.path.join(directory, f))
+
     end = datetime.now()
     diff = end - start
-    print('All cubes merged for ' + str(diff.seconds) + 's')
+    log.info('All cubes merged for ' + str(diff.seconds) + 's')
 
 
 
@@ -413,32 +469,33 @@ def safe_datacube(ds, name, directory):
         directory (str): Pathlike string to the directory
     '''
 
-    print("Start saving")
+    log.info("Start saving")
     start = datetime.now()
     ds.to_netcdf(directory + name + ".nc")
     diff = datetime.now() - start
-    print("Done saving after "+ str(diff.seconds) + 's')
+    log.info("Done saving after "+ str(diff.seconds) + 's')
 
 
 
 
 
-def merge_coords(ds_left, ds_right, name, directory):
+def merge_coords(ds_left, ds_right):
     '''
     Merges two datasets by coordinates
 
     Parameters:
         ds_left (xArray dataset): Dataset to be merged
         ds_right (xArray dataset): Dataset to be merged
-        name (str): Name of the new dataset
-        directory (str): Pathlike string to the directory
+    Returns:
+        merged (xArray dataset): The merged dataset, still lazy if the inputs are
     '''
 
-    ds_selected = ds_left.sel(lon = slice(ds_left.lon[0], ds_right.lon[0]))
-    ds_merge = [ds_selected, ds_right]
-    merged = xr.combine_by_coords(ds_merge)
-    safe_datacube(merged, name, directory)
-    merged.close()
+    '''The tiles are adjacent on the lon axis, so a direct concat avoids the full coordinate sort and alignment of combine_by_coords'''
+    n = np.searchsorted(ds_left.lon.values, float(ds_right.lon.values[0]))
+    if n == 0:
+        raise ValueError("ds_left does not lie left of ds_right on the lon axis")
+    merged = xr.concat([ds_left.isel(lon = slice(0, n)), ds_right], dim = 'lon', data_vars = 'minimal', coords = 'minimal', compat = 'override')
+    return merged
 
 
 
@@ -450,9 +507,8 @@ def delete(path):
     Parameters:
         path (str): Path to the file/directory
     '''
-    try: 
+    try:
         os.remove(path)
-        print("File was deleted")
     except FileNotFoundError:
         raise NoPath ("No file in this path")
 
@@ -462,7 +518,7 @@ def delete(path):
 
 def mainSentinel(resolution, directory, collectionDate, aoi, clouds, username, password, nameSentinel):
     '''
-    Downloads, unzips, collects and merges Sentinel2 Satelliteimages to a single netCDF4 datacube
+    Downloads, unzips, collects and merges Sentinel2 Satelliteimages to a single Zarr datacube
 
     Parameters:
         resolution (int): Resolution of the satelite image
@@ -5,10 +5,13 @@ from dask.distributed import Client, LocalCluster
 
 from ftplib import FTP
 from datetime import datetime
+import logging
 import xarray  as xr
 import os.path
 import numpy as np
 
+log = logging.getLogger(__name__)
+
 '''exceptions'''
 
 class FileNotFoundError(Exception):
@@ -65,12 +68,12 @@ def download_file(year, directory):
 
     for file in files:
         if file == 'sst.day.mean.' + str(year) + '.nc':
-            print("Downloading..." + file)
+            log.info("Downloading..." + file)
             ftp.retrbinary("RETR " + file, open(directory + file, 'wb').write)
             ftp.close()
             end = datetime.now()
             diff = end - start
-            print('File downloaded in ' + str(diff.seconds) + 's')
+            log.info('File downloaded in ' + str(diff.seconds) + 's')
             break
         else: counter += 1
 
@@ -87,7 +90,7 @@ def deleteNetcdf(path):
     if path[len(path)-3:len(path)] == ".nc":
         if os.path.exists(path):
             os.remove(path)
-            print("File deleted: " + path)
+            log.debug("File deleted: " + path)
         else:
             raise FileNotFoundError('No matching file found')
     else:
@@ -119,25 +122,19 @@ def generate_sst_datacube (yearBegin, yearEnd, directory, name):
     '''download sst data for the wanted years'''
     i = yearBegin
     files = []
-    ds_merge = []
     while i <= yearEnd:
         download_file(i, directory)
         files.append(os.path.join(directory,"sst.day.mean." + str(i) + ".nc"))
         i = i + 1
     '''merge sst data'''
-    for f in files:
-        x = xr.open_dataset(os.path.join(directory, f))
-        ds_merge.append(x)
-    datacube = xr.open_mfdataset(files, parallel=True, chunks={"time": "auto"})
-    '''datacube = xr.open_mfdataset(files,join="override") no dask'''
+    '''decode_cf=False skips the per-file CF metadata decoding during the open, the raw time units are written back to disk unchanged and decode on the next open; preprocess drops everything but sst before the graph is built'''
+    datacube = xr.open_mfdataset(files, parallel = True, combine = 'by_coords', decode_cf = False, chunks = {"time": "auto"}, preprocess = lambda ds: ds[["sst"]])
     '''save datacube'''
-    print("Start saving")
+    log.info("Start saving")
     datacube.to_netcdf(directory + name + ".nc", compute = True)
-    print("Done saving")
+    log.info("Done saving")
     datacube.close()
     '''delete yearly datasets'''
-    for f in ds_merge:
-        f.close()
     for f in files:
         deleteNetcdf(f)
 
@@ -3,7 +3,7 @@ current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfra
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir) 
 
-import os , sys, inspect, pytest, shutil, xarray as xr
+import os , sys, inspect, pytest, shutil, glob, numpy as np, xarray as xr
 import xarray  as xr
 from Sentinel2_Data import *
 from shutil import copyfile
@@ -62,55 +62,54 @@ def test_del():
     with pytest.raises(NoPath):
         delete(directory + "hello.rtf")
 	
-def test_delete_ispath(capfd):
+def test_delete_ispath():
     d = open(directory + "testfile", "w")
     d.close()
     delete(directory+"testfile")
-    out, err = capfd.readouterr()
-    assert out == "File was deleted\n"
+    assert os.path.exists(directory+"testfile") == False
 
 	    
 def test_extractBands10():
     filename = "S2A_MSIL2A_20200613T103031_N0214_R108_T32UMC_20200613T111252.SAFE"
-    lTwoA = os.listdir(os.path.join(directory, filename, "GRANULE"))
-    bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m"))
-    pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m", str(bandName[3]))
-    pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m", str(bandName[4]))
+    lTwoA = sorted(os.listdir(os.path.join(directory, filename, "GRANULE")))
+    imgData = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R10m")
+    pathRed = glob.glob(os.path.join(imgData, "*_B04_*.jp2"))[0]
+    pathNIR = glob.glob(os.path.join(imgData, "*_B08_*.jp2"))[0]
     bandPaths = [pathRed, pathNIR]
-    
+
     assert extractBands(filename, 10, directory) == bandPaths;
 
-	
+
 def test_extractBands20():
     filename = "S2A_MSIL2A_20200613T103031_N0214_R108_T32UMC_20200613T111252.SAFE"
-    lTwoA = os.listdir(os.path.join(directory, filename, "GRANULE"))
-    bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m"))
-    pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[3]))
-    pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[9]))
+    lTwoA = sorted(os.listdir(os.path.join(directory, filename, "GRANULE")))
+    imgData = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m")
+    pathRed = glob.glob(os.path.join(imgData, "*_B04_*.jp2"))[0]
+    pathNIR = glob.glob(os.path.join(imgData, "*_B8A_*.jp2"))[0]
     bandPaths = [pathRed, pathNIR]
-    
+
     assert extractBands(filename, 20, directory) == bandPaths;
-    
-	
+
+
 def test_extractBands60():
     filename = "S2A_MSIL2A_20200613T103031_N0214_R108_T32UMC_20200613T111252.SAFE"
-    lTwoA = os.listdir(os.path.join(directory, filename, "GRANULE"))
-    bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m"))
-    pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m", str(bandName[4]))
-    pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m", str(bandName[11]))
+    lTwoA = sorted(os.listdir(os.path.join(directory, filename, "GRANULE")))
+    imgData = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R60m")
+    pathRed = glob.glob(os.path.join(imgData, "*_B04_*.jp2"))[0]
+    pathNIR = glob.glob(os.path.join(imgData, "*_B8A_*.jp2"))[0]
     bandPaths = [pathRed, pathNIR]
-    
+
     assert extractBands(filename, 60, directory) == bandPaths;
-  
-	
+
+
 def test_extractBands100():
     filename = "S2A_MSIL2A_20200613T103031_N0214_R108_T32UMC_20200613T111252.SAFE"
-    lTwoA = os.listdir(os.path.join(directory, filename, "GRANULE"))
-    bandName = os.listdir (os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m"))
-    pathRed = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[3]))
-    pathNIR = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m", str(bandName[9]))
+    lTwoA = sorted(os.listdir(os.path.join(directory, filename, "GRANULE")))
+    imgData = os.path.join(directory, filename, "GRANULE", str(lTwoA[0]), "IMG_DATA", "R20m")
+    pathRed = glob.glob(os.path.join(imgData, "*_B04_*.jp2"))[0]
+    pathNIR = glob.glob(os.path.join(imgData, "*_B8A_*.jp2"))[0]
     bandPaths = [pathRed, pathNIR]
-    
+
     assert extractBands(filename, 100, directory) == bandPaths;
 
 	
@@ -157,6 +156,25 @@ def test_loadBand2():
         bandPath = extractBands(os.path.join(directory, filename), resolution, directory)
         loadBand(bandPath, getDate(filename), getTile(filename), resolution, clouds, plName, prLevel, directory) 
 	
+def test_ndvi1():
+    red = np.array([[500, 2000], [1000, 3000]], dtype = np.uint16)
+    nir = np.array([[1500, 6000], [1000, 1000]], dtype = np.uint16)
+    result = ndvi(red, nir)
+
+    assert result.dtype == np.float32
+    assert result.shape == red.shape
+    assert result[0][0] == pytest.approx(0.5)
+    assert result[0][1] == pytest.approx(0.5)
+    assert result[1][0] == pytest.approx(0.0)
+    assert result[1][1] == pytest.approx(-0.5)
+
+def test_ndvi2():
+    red = np.zeros((2, 2), dtype = np.uint16)
+    nir = np.zeros((2, 2), dtype = np.uint16)
+    result = ndvi(red, nir)
+
+    assert np.all(result == 0)
+
 def test_buildCube1():
     with pytest.raises(NoResolution):
         buildCube(directory, 70, clouds, plName, prLevel)
@@ -196,14 +214,15 @@ def test_mergeSentinel2(capfd):
 def test_merge_coords_1():
     ds_2 = xr.open_dataset(os.path.join(directory,"datacube_2020-06-01_T32UMC_R100.nc"))
     ds_1 = xr.open_dataset(os.path.join(directory,"datacube_2020-06-01_T32ULC_R100.nc"))
-    merge_coords(ds_1,ds_2,name,directory)
-    assert os.path.exists(directory + name + ".nc")==True
-	
+    merged = merge_coords(ds_1,ds_2)
+    assert float(merged.lon[0]) == float(ds_1.lon[0])
+    assert float(merged.lon[-1]) == float(ds_2.lon[-1])
+
 def test_merge_coords_2():
     ds_2 = xr.open_dataset(os.path.join(directory,"datacube_2020-06-01_T32UMC_R100.nc"))
     ds_1 = xr.open_dataset(os.path.join(directory,"datacube_2020-06-01_T32ULC_R100.nc"))
-    with pytest.raises(ValueError): 
-        merge_coords(ds_2,ds_1,name,directory)
+    with pytest.raises(ValueError):
+        merge_coords(ds_2,ds_1)
 
 	
 def test_safe_datacube1():
@@ -225,13 +244,12 @@ def test_mergeSentinel1():
         merge_Sentinel(directory+"empty", "Datacube_Sentinel")
     shutil.rmtree(directory+"empty")
 	
-def test_mergeSentinel2(capfd):
+def test_mergeSentinel2():
     os.mkdir(directory+"onefile/")
     d = open(directory +"onefile/testfile.nc", "w")
     d.close()
     merge_Sentinel(directory+"onefile/", "Datacube_Sentinel")
-    out, err = capfd.readouterr()
-    assert out == "Only one file in directory\n"
+    assert os.path.exists(directory+"onefile/merged_cube.nc") == True
     shutil.rmtree(directory+"onefile")
     
 # def test_mergeSentinel3():